@@ -33,6 +33,11 @@ do
   python -m pytest ${package}
 done
 
+# The helpers shared by the rez build.py scripts live in proto but aren't part of the opencue_proto package,
+# so their tests run from the source tree. grpcio-tools comes with opencue_proto.
+pip install loguru
+python -m pytest proto/tests
+
 # Xvfb no longer supports Python 2.
 if [[ "$python_version" =~ "Python 3" && ${args[0]} != "--no-gui" ]]; then
   ci/run_gui_test.sh
@@ -4,16 +4,23 @@
 
 import os
 import os.path
-import pathlib
-import shutil
 import sys
+import time
 from typing import List
 
 from loguru import logger
 
+# The copy and install helpers come from opencue_build_common in ../proto, so building cuegui needs the
+# OpenCue source tree around it, and Linux for the fcntl and O_DIRECTORY calls those helpers rely on
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "proto"))
 
-class TestError(Exception):
-    pass
+from opencue_build_common import (  # noqa: E402
+    TestError,
+    deferred_discards,
+    replace_tree,
+    sync_entries,
+    sync_tree,
+)
 
 
 def build(source_path: str, build_path: str, install_path: str, targets: List[str]) -> None:
@@ -29,37 +36,27 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         os.makedirs(python_build_dir, exist_ok=True)
 
         # Walk only one level of the source path
-        _source_path = pathlib.Path(source_path)
-        for path in _source_path.iterdir():
-            logger.info(f"Processing: {path.name}")
-
-            if path.name == "build":
-                # Skip the build directory
-                continue
-
-            # Handle all other files/directories
-            dest = os.path.join(python_build_dir, path.name)
-
-            # Check if destination exists and remove it
-            if os.path.exists(dest):
-                logger.info(f"Removing existing: {dest}")
-                if os.path.isdir(dest):
-                    shutil.rmtree(dest)
-                else:
-                    os.remove(dest)
-
-            # Copy the file or directory
-            logger.info(f"Copying {path.name} to {dest}")
-            if path.is_dir():
-                shutil.copytree(str(path), dest)
-            else:
-                shutil.copy2(str(path), dest)
+        entries = []
+        with os.scandir(source_path) as it:
+            for entry in it:
+                logger.debug("Processing: {}", entry.name)
+
+                if entry.name == "build":
+                    # Skip the build directory
+                    continue
+
+                entries.append(entry)
+
+        # Copy the files and directories, replacing whatever stale entries are in the way
+        start = time.perf_counter()
+        sync_entries(source_path, python_build_dir, entries)
+        logger.info(f"Copied {len(entries)} entries to {python_build_dir} in {time.perf_counter() - start:.2f}s")
 
         # Copy the bin directory from the source path
         bin_build_dir = os.path.join(build_path, "cuegui", "bin")
         logger.debug(f"Copying bin directory from {bin_build_dir}")
         if os.path.exists(bin_build_dir):
-            shutil.copytree(bin_build_dir, os.path.join(build_path, "bin"))
+            sync_tree(bin_build_dir, os.path.join(build_path, "bin"))
 
     def _install():
         logger.info("Installing files and directories")
@@ -68,26 +65,21 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         python_build_dir = os.path.join(build_path)
         if os.path.exists(python_build_dir):
             python_install_dir = os.path.join(install_path)
-            if os.path.exists(python_install_dir):
-                shutil.rmtree(python_install_dir)
-
             logger.info(f"Copying from {python_build_dir} to {python_install_dir}")
-            shutil.copytree(python_build_dir, python_install_dir)
+            replace_tree(python_build_dir, python_install_dir)
 
         # Install the bin directory
         bin_build_dir = os.path.join(build_path, "bin")
         if os.path.exists(bin_build_dir):
             bin_install_dir = os.path.join(install_path, "bin")
-            if os.path.exists(bin_install_dir):
-                shutil.rmtree(bin_install_dir)
-
             logger.info(f"Copying from {bin_build_dir} to {bin_install_dir}")
-            shutil.copytree(bin_build_dir, bin_install_dir)
+            replace_tree(bin_build_dir, bin_install_dir)
 
     _build()
 
     if "install" in (targets or []):
-        _install()
+        with deferred_discards():
+            _install()
 
 
 if __name__ == "__main__":
@@ -2,20 +2,159 @@
 
 # Copyright (c) 2025. Od Studios, www.theodstudios.com, All rights reserved
 
+import fnmatch
 import os
 import os.path
-import shutil
+import re
+import stat
 import subprocess
 import sys
+import time
 from typing import List
 
 from loguru import logger
 
+# CueWeb is a Node.js package, but this script copies and installs it with opencue_build_common from ../proto,
+# so building it needs the OpenCue source tree around it, and Linux for the fcntl and O_DIRECTORY calls those
+# helpers rely on
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "proto"))
+
+from opencue_build_common import (  # noqa: E402
+    copy_file,
+    deferred_discards,
+    remove_path,
+    replace_tree,
+    sync_entries,
+    write_executable,
+)
+
 
 class BuildError(Exception):
     pass
 
 
+# Source entries that are never copied to the build directory, matched as name prefixes
+_SKIP_PREFIXES = ("node_modules", "__pycache__", "build", ".git", ".env", ".next")
+
+# Build directory entries that aren't needed at runtime, as glob patterns relative to the build path
+_CLEANUP_PATTERNS = [
+    "src",
+    "app/__tests__",
+    "jest",
+    "jest.config.js",
+    ".eslintrc.json",
+    ".prettierrc.json",
+    ".prettierignore",
+    "README.md",
+    "tailwind.config.js",
+    "tailwind.config.ts",
+    "tsconfig.json",
+    "postcss.config.js",
+    "components.json",
+    "Dockerfile",
+    "sentry.*.config.ts",
+    "build.py",
+    "interface_screenshots",
+]
+
+# Single regex matching a top level entry name against any of the cleanup patterns
+_CLEANUP_RE = re.compile("|".join(fnmatch.translate(p) for p in _CLEANUP_PATTERNS if "/" not in p))
+
+# Contents of bin/cueweb, encoded once so it can be written without going through a text layer
+_CUEWEB_SCRIPT = b"""#!/bin/bash
+# CueWeb startup script
+
+# Get the directory where this script is located
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+CUEWEB_ROOT="$(dirname "$SCRIPT_DIR")"
+
+# Set environment variables
+export NODE_ENV=production
+export NEXT_TELEMETRY_DISABLED=1
+
+# Default values
+CUEWEB_PORT=${CUEWEB_PORT:-3000}
+CUEWEB_HOST=${CUEWEB_HOST:-0.0.0.0}
+
+# Parse command line arguments
+COMMAND="start"
+while [[ $# -gt 0 ]]; do
+    case $1 in
+        --dev|--development)
+            COMMAND="dev"
+            export NODE_ENV=development
+            shift ;;
+        --port=*) CUEWEB_PORT="${1#*=}"; shift ;;
+        --port) CUEWEB_PORT="$2"; shift 2 ;;
+        --host=*) CUEWEB_HOST="${1#*=}"; shift ;;
+        --host) CUEWEB_HOST="$2"; shift 2 ;;
+        --help|-h)
+            echo "CueWeb - Web-based OpenCue management interface"
+            echo "Usage: cueweb [options]"
+            echo "Options:"
+            echo "  --dev, --development   Run in development mode"
+            echo "  --port=PORT           Port to run on (default: 3000)"
+            echo "  --host=HOST           Host to bind to (default: 0.0.0.0)"
+            echo "  --help, -h            Show this help message"
+            echo ""
+            echo "Required Environment Variables:"
+            echo "  NEXT_PUBLIC_OPENCUE_ENDPOINT   OpenCue REST API endpoint"
+            echo "  NEXT_JWT_SECRET                JWT secret for API authentication"
+            exit 0 ;;
+        *) echo "Unknown option: $1"; echo "Use --help for usage."; exit 1 ;;
+    esac
+done
+
+# Check required environment variables
+if [ -z "$NEXT_PUBLIC_OPENCUE_ENDPOINT" ] || [ -z "$NEXT_JWT_SECRET" ]; then
+    echo "Error: Required environment variables not set:"
+    echo "  NEXT_PUBLIC_OPENCUE_ENDPOINT"
+    echo "  NEXT_JWT_SECRET" 
+    exit 1
+fi
+
+# Change to CueWeb directory
+cd "$CUEWEB_ROOT"
+
+# Check if node_modules exists and has the next binary
+if [ ! -f "node_modules/.bin/next" ]; then
+    echo "Installing Node.js dependencies..."
+    if ! command -v npm &> /dev/null; then
+        echo "Error: npm is not available. Please install Node.js and npm."
+        exit 1
+    fi
+    
+    # Install dependencies
+    npm ci --production=false --silent
+    if [ $? -ne 0 ]; then
+        echo "Error: Failed to install dependencies"
+        exit 1
+    fi
+    echo "Dependencies installed successfully"
+fi
+
+# Set the port for Next.js
+export PORT="$CUEWEB_PORT"
+
+echo "Starting CueWeb on ${CUEWEB_HOST}:${CUEWEB_PORT}"
+echo "CueWeb root: $CUEWEB_ROOT"
+
+# Start the application
+exec npm run "$COMMAND" -- --port "$CUEWEB_PORT" --hostname "$CUEWEB_HOST"
+"""
+
+
+def _run_streaming(cmd: List[str], cwd: str, env: dict) -> None:
+    """Run a command, logging its combined output line by line as it is produced."""
+    with subprocess.Popen(
+        cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True
+    ) as proc:
+        for line in proc.stdout:
+            logger.info(line.rstrip())
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
 def build(source_path: str, build_path: str, install_path: str, targets: List[str]) -> None:
     logger.info(f"Source Path -> {source_path}")
     logger.info(f"Build Path -> {build_path}")
@@ -48,31 +187,25 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         # Note: build_path already exists and contains Rez files, so we copy into it
 
         # Copy source files into the existing build directory
-        for item in os.listdir(source_path):
-            # Skip hidden files and directories that start with '.'
-            if item.startswith("."):
-                continue
-
-            src_item = os.path.join(source_path, item)
-            dest_item = os.path.join(build_path, item)
-
-            # Skip patterns we don't want
-            skip_patterns = ["node_modules", "__pycache__", "build", ".git", ".env", ".next"]
-
-            if any(item.startswith(pattern) or item == pattern for pattern in skip_patterns):
-                logger.info(f"Skipping {item}")
-                continue
-
-            if os.path.isdir(src_item):
-                if os.path.exists(dest_item):
-                    shutil.rmtree(dest_item)
-                shutil.copytree(src_item, dest_item)
-            else:
-                shutil.copy2(src_item, dest_item)
-
-            logger.debug(f"Copied {item} to build directory")
-
-        logger.info(f"Source files copied to build directory: {build_path}")
+        entries = []
+        with os.scandir(source_path) as it:
+            for entry in it:
+                # Skip hidden files and directories that start with '.'
+                if entry.name.startswith("."):
+                    continue
+
+                # Skip patterns we don't want
+                if entry.name.startswith(_SKIP_PREFIXES):
+                    logger.debug("Skipping {}", entry.name)
+                    continue
+
+                entries.append(entry)
+
+        # Unchanged files already in the build directory aren't copied again
+        start = time.perf_counter()
+        sync_entries(source_path, build_path, entries)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Copied {len(entries)} source entries to build directory {build_path} in {elapsed:.2f}s")
 
         # Check if npm is available
         try:
@@ -117,14 +250,10 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         try:
             cmd = ["npm", "ci", "--production=false"]
             logger.info(f"Running: {' '.join(cmd)}")
-            subprocess.run(cmd, cwd=build_path, check=True, capture_output=True, text=True, env=build_env)
+            _run_streaming(cmd, cwd=build_path, env=build_env)
             logger.info("Dependencies installed successfully")
         except subprocess.CalledProcessError as e:
             logger.error(f"Failed to install dependencies: {e}")
-            if e.stdout:
-                logger.error(f"stdout: {e.stdout}")
-            if e.stderr:
-                logger.error(f"stderr: {e.stderr}")
             raise BuildError(f"npm install failed with return code {e.returncode}")
 
         # Build the Next.js application
@@ -132,14 +261,10 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         try:
             cmd = ["npm", "run", "build"]
             logger.info(f"Running: {' '.join(cmd)}")
-            subprocess.run(cmd, cwd=build_path, check=True, capture_output=True, text=True, env=build_env)
+            _run_streaming(cmd, cwd=build_path, env=build_env)
             logger.info("Next.js build completed successfully")
         except subprocess.CalledProcessError as e:
             logger.error(f"Failed to build Next.js application: {e}")
-            if e.stdout:
-                logger.error(f"stdout: {e.stdout}")
-            if e.stderr:
-                logger.error(f"stderr: {e.stderr}")
             raise BuildError(f"npm build failed with return code {e.returncode}")
 
         # Create executable script
@@ -154,124 +279,35 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
         os.makedirs(bin_dir, exist_ok=True)
         cueweb_exe = os.path.join(bin_dir, "cueweb")
 
-        script_content = """#!/bin/bash
-# CueWeb startup script
-
-# Get the directory where this script is located
-SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
-CUEWEB_ROOT="$(dirname "$SCRIPT_DIR")"
-
-# Set environment variables
-export NODE_ENV=production
-export NEXT_TELEMETRY_DISABLED=1
-
-# Default values
-CUEWEB_PORT=${CUEWEB_PORT:-3000}
-CUEWEB_HOST=${CUEWEB_HOST:-0.0.0.0}
-
-# Parse command line arguments
-COMMAND="start"
-while [[ $# -gt 0 ]]; do
-    case $1 in
-        --dev|--development)
-            COMMAND="dev"
-            export NODE_ENV=development
-            shift ;;
-        --port=*) CUEWEB_PORT="${1#*=}"; shift ;;
-        --port) CUEWEB_PORT="$2"; shift 2 ;;
-        --host=*) CUEWEB_HOST="${1#*=}"; shift ;;
-        --host) CUEWEB_HOST="$2"; shift 2 ;;
-        --help|-h)
-            echo "CueWeb - Web-based OpenCue management interface"
-            echo "Usage: cueweb [options]"
-            echo "Options:"
-            echo "  --dev, --development   Run in development mode"
-            echo "  --port=PORT           Port to run on (default: 3000)"
-            echo "  --host=HOST           Host to bind to (default: 0.0.0.0)"
-            echo "  --help, -h            Show this help message"
-            echo ""
-            echo "Required Environment Variables:"
-            echo "  NEXT_PUBLIC_OPENCUE_ENDPOINT   OpenCue REST API endpoint"
-            echo "  NEXT_JWT_SECRET                JWT secret for API authentication"
-            exit 0 ;;
-        *) echo "Unknown option: $1"; echo "Use --help for usage."; exit 1 ;;
-    esac
-done
-
-# Check required environment variables
-if [ -z "$NEXT_PUBLIC_OPENCUE_ENDPOINT" ] || [ -z "$NEXT_JWT_SECRET" ]; then
-    echo "Error: Required environment variables not set:"
-    echo "  NEXT_PUBLIC_OPENCUE_ENDPOINT"
-    echo "  NEXT_JWT_SECRET" 
-    exit 1
-fi
-
-# Change to CueWeb directory
-cd "$CUEWEB_ROOT"
-
-# Check if node_modules exists and has the next binary
-if [ ! -f "node_modules/.bin/next" ]; then
-    echo "Installing Node.js dependencies..."
-    if ! command -v npm &> /dev/null; then
-        echo "Error: npm is not available. Please install Node.js and npm."
-        exit 1
-    fi
-    
-    # Install dependencies
-    npm ci --production=false --silent
-    if [ $? -ne 0 ]; then
-        echo "Error: Failed to install dependencies"
-        exit 1
-    fi
-    echo "Dependencies installed successfully"
-fi
-
-# Set the port for Next.js
-export PORT="$CUEWEB_PORT"
-
-echo "Starting CueWeb on ${CUEWEB_HOST}:${CUEWEB_PORT}"
-echo "CueWeb root: $CUEWEB_ROOT"
-
-# Start the application
-exec npm run "$COMMAND" -- --port "$CUEWEB_PORT" --hostname "$CUEWEB_HOST"
-"""
-
-        with open(cueweb_exe, "w") as f:
-            f.write(script_content)
-
-        os.chmod(cueweb_exe, 0o755)
+        write_executable(cueweb_exe, _CUEWEB_SCRIPT)
         logger.info(f"Created cueweb executable at {cueweb_exe}")
 
     def _cleanup_build_directory():
         """Remove unnecessary files from build directory, keep only runtime artifacts"""
-        cleanup_patterns = [
-            "src",
-            "app/__tests__",
-            "jest",
-            "jest.config.js",
-            ".eslintrc.json",
-            ".prettierrc.json",
-            ".prettierignore",
-            "README.md",
-            "tailwind.config.js",
-            "tailwind.config.ts",
-            "tsconfig.json",
-            "postcss.config.js",
-            "components.json",
-            "Dockerfile",
-            "sentry.*.config.ts",
-            "build.py",
-            "interface_screenshots",
-        ]
-
-        for pattern in cleanup_patterns:
-            path = os.path.join(build_path, pattern)
-            if os.path.exists(path):
-                if os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
-                logger.info(f"Removed {pattern} from build directory")
+        # Match every top level entry against all the patterns in a single pass, keeping the
+        # entry type from the directory listing so removal doesn't need another stat
+        with os.scandir(build_path) as it:
+            matches = [
+                (entry.name, entry.is_dir(follow_symlinks=False)) for entry in it if _CLEANUP_RE.match(entry.name)
+            ]
+
+        # Nested paths aren't part of the top level listing, so those are looked up directly
+        for pattern in _CLEANUP_PATTERNS:
+            if "/" not in pattern:
+                continue
+            try:
+                st = os.lstat(os.path.join(build_path, pattern))
+            except FileNotFoundError:
+                continue
+            matches.append((pattern, stat.S_ISDIR(st.st_mode)))
+
+        for name, is_dir in matches:
+            path = os.path.join(build_path, name)
+            if is_dir:
+                remove_path(path)
+            else:
+                os.unlink(path)
+            logger.info(f"Removed {name} from build directory")
 
     def _install():
         """Install only the necessary runtime artifacts"""
@@ -283,19 +319,16 @@ exec npm run "$COMMAND" -- --port "$CUEWEB_PORT" --hostname "$CUEWEB_HOST"
                 logger.warning(f"Artifact {artifact} not found in build directory, skipping")
                 continue
 
-            # Remove existing destination (handle both files and directories)
-            if os.path.exists(dest):
-                if os.path.isdir(dest):
-                    shutil.rmtree(dest)
-                else:
-                    os.remove(dest)
-
+            # Swap the new copy in place of the existing destination, so it's never missing or partial
             logger.info(f"Installing: {src} to {dest}")
             if os.path.isdir(src):
-                shutil.copytree(src, dest)
+                replace_tree(src, dest)
             else:
                 os.makedirs(os.path.dirname(dest), exist_ok=True)
-                shutil.copy2(src, dest)
+                staging = os.path.join(install_path, f".{artifact}.new")
+                remove_path(staging)
+                copy_file(src, staging, os.stat(src))
+                os.replace(staging, dest)
 
         # Ensure executable permissions for bin files
         # bin_dir = os.path.join(install_path, "bin")
@@ -307,7 +340,8 @@ exec npm run "$COMMAND" -- --port "$CUEWEB_PORT" --hostname "$CUEWEB_HOST"
     _build()
 
     if "install" in (targets or []):
-        _install()
+        with deferred_discards():
+            _install()
 
 
 if __name__ == "__main__":
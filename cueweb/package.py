@@ -19,14 +19,15 @@ uuid = "repository.cueweb"
 
 def commands():
     import json
-    import os
 
-    # Load secrets from external JSON file
+    # Load secrets from external JSON file, a missing file falls back to the defaults below
     secrets_file = "/od/.farm_web.json"
     secrets = {}
-    if os.path.exists(secrets_file):
-        with open(secrets_file, "r") as f:
-            secrets = json.load(f)
+    try:
+        with open(secrets_file, "rb") as f:
+            secrets = json.loads(f.read())
+    except FileNotFoundError:
+        pass
     env.PATH.append("{root}/bin")
     env.NEXT_JWT_SECRET = secrets.get("NEXT_JWT_SECRET", "default-jwt-secret")
     # NOTE: NEXT_PUBLIC_OPENCUE_ENDPOINT is overridden in build.py due to rez environment variable issues
@@ -8,11 +8,11 @@ import re
 import sys
 import glob
 
-PYTHON_SCRIPT_PATH = sys.argv[1]
 
-if os.path.isdir(PYTHON_SCRIPT_PATH):
+def fix_compiled_proto(python_script_path):
+    """Make the imports in the *_pb2*.py files of python_script_path relative."""
     pattern = re.compile(r"^import \w+ as \w+_pb2")
-    for filepath in glob.glob(os.path.join(PYTHON_SCRIPT_PATH, "*_pb2*.py")):
+    for filepath in glob.glob(os.path.join(python_script_path, "*_pb2*.py")):
         filedata = []
         with open(filepath) as f:
             for line in f.readlines():
@@ -22,5 +22,12 @@ if os.path.isdir(PYTHON_SCRIPT_PATH):
                 filedata.append(line.strip("\n"))
         with open(filepath, "w") as f:
             f.write("\n".join(filedata))
-else:
-    print("Argument is not a directory")
+
+
+if __name__ == "__main__":
+    PYTHON_SCRIPT_PATH = sys.argv[1]
+
+    if os.path.isdir(PYTHON_SCRIPT_PATH):
+        fix_compiled_proto(PYTHON_SCRIPT_PATH)
+    else:
+        print("Argument is not a directory")
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2025. Od Studios, www.theodstudios.com, All rights reserved
+
+"""Helpers shared by the rez build.py scripts of OpenCue's packages.
+
+pycue and rqd compile the .proto files found here with compile_protos, which is the only part needing grpc_tools.
+The file helpers are Linux only, as they rely on fcntl, O_DIRECTORY, sendfile and copy_file_range.
+"""
+
+import contextlib
+import errno
+import fcntl
+import importlib.resources
+import importlib.util
+import os
+import os.path
+import shutil
+import stat
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from typing import List, Optional
+
+from loguru import logger
+
+
+class TestError(Exception):
+    pass
+
+
+# Number of threads copying files in copytree, and removing the top level entries in remove_path
+_COPY_WORKERS = 16
+
+# Chunk size for sendfile and the read/write fallback
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# copy_file_range can clone a whole file in one call on CoW filesystems, so ask for large chunks
+_CLONE_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# Files at least this large get page cache hints while they are copied
+_FADVISE_MIN_SIZE = 256 * 1024
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+
+# Number of processes compiling .proto files, as grpc_tools' protoc holds the GIL while it runs
+_PROTOC_WORKERS = os.cpu_count() or 1
+
+# grpc_tools generates Python 3 code already, so 2to3 only runs over it when FORCE_2TO3=1 is set
+_FORCE_2TO3 = os.environ.get("FORCE_2TO3") == "1"
+
+# Reflink ioctl from linux/fs.h, only exposed by the fcntl module from Python 3.12 on
+_FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+# FICLONE/copy_file_range errors that mean the kernel or filesystem can't do it for these files
+_CLONE_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY)
+
+# Flags for opening a directory to use as the dir_fd of relative operations
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY
+
+
+def write_executable(path: str, content: bytes) -> None:
+    """Write an executable script with a single write on a descriptor created with its final mode."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    try:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view):]
+        # The creation mode is filtered by the umask and doesn't apply to an existing file
+        os.fchmod(fd, 0o755)
+    finally:
+        os.close(fd)
+
+
+def _copy_fd(src_fd: int, dst_fd: int) -> None:
+    """Copy the rest of src_fd into dst_fd from their current offsets, in kernel space where possible."""
+    try:
+        while os.sendfile(dst_fd, src_fd, None, _COPY_CHUNK_SIZE) > 0:
+            pass
+        return
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise
+
+    # sendfile is not supported for this pair of files, fall back to a plain read/write loop
+    buf = memoryview(bytearray(_COPY_CHUNK_SIZE))
+    with open(src_fd, "rb", buffering=0, closefd=False) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(dst_fd, buf[written:n])
+
+
+def _clone_or_copy(src_fd: int, dst_fd: int) -> None:
+    """Clone the data as a FICLONE reflink or with copy_file_range where the filesystem allows it, else _copy_fd it."""
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return
+    except OSError as e:
+        if e.errno not in _CLONE_UNSUPPORTED_ERRNOS:
+            raise
+
+    # copy_file_range moves both file offsets, so _copy_fd picks up wherever it stopped. Some filesystems
+    # accept the call without copying anything, so like shutil, nothing copied by the first call means
+    # it isn't supported rather than an empty source.
+    try:
+        if os.copy_file_range(src_fd, dst_fd, _CLONE_CHUNK_SIZE) > 0:
+            while os.copy_file_range(src_fd, dst_fd, _CLONE_CHUNK_SIZE) > 0:
+                pass
+            return
+    except OSError as e:
+        if e.errno not in _CLONE_UNSUPPORTED_ERRNOS:
+            raise
+
+    _copy_fd(src_fd, dst_fd)
+
+
+def copy_file(src: str, dst: str, st: os.stat_result, src_dir_fd: int = None, dst_dir_fd: int = None) -> None:
+    """Copy a regular file, applying the mode and times from its already known stat result."""
+    mode = st.st_mode & 0o7777
+    # Large files are read once front to back and not again, so tell the kernel not to keep them cached
+    advise = _HAS_FADVISE and st.st_size >= _FADVISE_MIN_SIZE
+    src_fd = os.open(src, os.O_RDONLY, dir_fd=src_dir_fd)
+    try:
+        if advise:
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode, dir_fd=dst_dir_fd)
+        try:
+            _clone_or_copy(src_fd, dst_fd)
+            if advise:
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.posix_fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.fchmod(dst_fd, mode)
+            os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def copytree(src: str, dst: str, ignore=None, workers: int = _COPY_WORKERS) -> None:
+    """Recursive copy like shutil.copytree, reusing the entries returned by os.scandir.
+
+    Symlinks are recreated as links. The directories are created as the tree is walked and the file copies are
+    spread over a thread pool. ignore works as in shutil.copytree, and is called once for every directory.
+    """
+    os.makedirs(dst, exist_ok=True)
+    dirs = [(src, dst)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        # dirs grows while it is iterated, as the subdirectories are found
+        for path, dest in dirs:
+            with os.scandir(path) as it:
+                entries = list(it)
+            if ignore is not None:
+                ignored = ignore(path, [entry.name for entry in entries])
+                entries = [entry for entry in entries if entry.name not in ignored]
+
+            # Join the destination paths by concatenation, os.path.join is measurable in this loop
+            prefix = os.path.join(dest, "")
+            for entry in entries:
+                target = prefix + entry.name
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                elif entry.is_dir():
+                    try:
+                        os.mkdir(target)
+                    except FileExistsError:
+                        pass
+                    dirs.append((entry.path, target))
+                else:
+                    futures.append(executor.submit(copy_file, entry.path, target, entry.stat()))
+
+        # Surface the first copy error, if any
+        for future in futures:
+            future.result()
+
+    # Directory modes and times are applied last, once nothing else gets written into them
+    for path, dest in reversed(dirs):
+        shutil.copystat(path, dest)
+
+
+def _remove_at(entry: os.DirEntry, dir_fd: int) -> None:
+    """Remove a file or directory tree listed in the directory open as dir_fd."""
+    if entry.is_dir(follow_symlinks=False):
+        sub_fd = os.open(entry.name, _DIR_FLAGS | os.O_NOFOLLOW, dir_fd=dir_fd)
+        try:
+            _rmtree_fd(sub_fd)
+        finally:
+            os.close(sub_fd)
+        os.rmdir(entry.name, dir_fd=dir_fd)
+    else:
+        os.unlink(entry.name, dir_fd=dir_fd)
+
+
+def _rmtree_fd(dir_fd: int) -> None:
+    """Remove everything inside the directory open as dir_fd, resolving each entry relative to it."""
+    with os.scandir(dir_fd) as it:
+        entries = list(it)
+    for entry in entries:
+        _remove_at(entry, dir_fd)
+
+
+def remove_path(path: str) -> None:
+    """Remove whatever file, symlink or directory tree is at path, if anything, without a stat beforehand.
+
+    Entries are classified from os.scandir and removed relative to their open parent directory. The top level
+    entries are removed concurrently, so their unlink round trips overlap on NFS.
+    """
+    try:
+        dir_fd = os.open(path, _DIR_FLAGS | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        # A file, or a symlink which is never followed
+        if e.errno not in (errno.ENOTDIR, errno.ELOOP):
+            raise
+        os.unlink(path)
+        return
+
+    try:
+        with os.scandir(dir_fd) as it:
+            entries = list(it)
+        if len(entries) > 1:
+            with ThreadPoolExecutor(max_workers=_COPY_WORKERS) as executor:
+                futures = [executor.submit(_remove_at, entry, dir_fd) for entry in entries]
+                # Surface the first removal error, if any
+                for future in futures:
+                    future.result()
+        else:
+            for entry in entries:
+                _remove_at(entry, dir_fd)
+    finally:
+        os.close(dir_fd)
+    os.rmdir(path)
+
+
+def _sync_entry(entry: os.DirEntry, old: Optional[os.DirEntry], src_fd: int, dst_fd: int) -> None:
+    """Bring entry.name under dst_fd in line with the source entry, replacing old if it's in the way.
+
+    Everything is resolved relative to the open parent directories and the stat result cached by
+    os.scandir is used for the copy, the mode bits and the times, so no extra stat is needed.
+    """
+    # Symlinks are recreated as links rather than copying what they point to
+    if entry.is_symlink():
+        target = os.readlink(entry.name, dir_fd=src_fd)
+        if old is not None:
+            if old.is_symlink() and os.readlink(old.name, dir_fd=dst_fd) == target:
+                return
+            _remove_at(old, dst_fd)
+        os.symlink(target, entry.name, dir_fd=dst_fd)
+        return
+
+    st = entry.stat()
+    is_dir = stat.S_ISDIR(st.st_mode)
+    if old is not None and (old.is_symlink() or old.is_dir(follow_symlinks=False) != is_dir):
+        _remove_at(old, dst_fd)
+        old = None
+
+    if not is_dir:
+        # Copies keep the source size, mtime and mode, so a match means the file is already up to date
+        if old is not None:
+            old_st = old.stat(follow_symlinks=False)
+            if (old_st.st_size, old_st.st_mtime_ns, old_st.st_mode) == (st.st_size, st.st_mtime_ns, st.st_mode):
+                return
+            # Write a new file instead of truncating the stale one, which may be read-only or open elsewhere
+            os.unlink(entry.name, dir_fd=dst_fd)
+        copy_file(entry.name, entry.name, st, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+        return
+
+    if old is None:
+        os.mkdir(entry.name, dir_fd=dst_fd)
+    src_sub_fd = os.open(entry.name, _DIR_FLAGS, dir_fd=src_fd)
+    try:
+        dst_sub_fd = os.open(entry.name, _DIR_FLAGS | os.O_NOFOLLOW, dir_fd=dst_fd)
+        try:
+            _sync_dir(src_sub_fd, dst_sub_fd)
+            os.fchmod(dst_sub_fd, st.st_mode & 0o7777)
+            os.utime(dst_sub_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst_sub_fd)
+    finally:
+        os.close(src_sub_fd)
+
+
+def _sync_dir(src_fd: int, dst_fd: int) -> None:
+    """Make the directory open as dst_fd mirror the one open as src_fd, in one pass over each."""
+    with os.scandir(dst_fd) as it:
+        existing = {entry.name: entry for entry in it}
+    with os.scandir(src_fd) as it:
+        entries = list(it)
+
+    for entry in entries:
+        _sync_entry(entry, existing.pop(entry.name, None), src_fd, dst_fd)
+
+    # Whatever is left no longer exists in the source
+    for old in existing.values():
+        _remove_at(old, dst_fd)
+
+
+def sync_tree(src: str, dst: str) -> None:
+    """Mirror the src directory tree into dst, replacing stale entries in the same pass as the copy."""
+    try:
+        os.mkdir(dst)
+    except FileExistsError:
+        pass
+    src_fd = os.open(src, _DIR_FLAGS)
+    try:
+        dst_fd = os.open(dst, _DIR_FLAGS | os.O_NOFOLLOW)
+        try:
+            _sync_dir(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def sync_entries(src: str, dst: str, entries: List[os.DirEntry], workers: int = _COPY_WORKERS) -> None:
+    """Mirror the given entries of the src directory into the existing dst directory, each as sync_tree does.
+
+    The entries are independent, so they are synced concurrently. Entries of dst missing from entries are
+    left alone, as the build paths hold files of their own next to the copied sources.
+    """
+    # Index what dst already holds, so stale entries are handled while copying
+    with os.scandir(dst) as it:
+        existing = {entry.name: entry for entry in it}
+
+    def _sync_one(entry):
+        logger.debug("Copying {} to {}", entry.name, dst)
+        _sync_entry(entry, existing.get(entry.name), src_fd, dst_fd)
+
+    src_fd = os.open(src, _DIR_FLAGS)
+    try:
+        dst_fd = os.open(dst, _DIR_FLAGS)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_sync_one, entries))
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+class _DiscardThread(threading.Thread):
+    """Removes a tree retired by replace_tree, keeping the error it failed with for deferred_discards."""
+
+    def __init__(self, path: str):
+        super().__init__(name=f"discard-{os.path.basename(path)}")
+        self.path = path
+        self.error = None
+
+    def run(self):
+        try:
+            remove_path(self.path)
+        except Exception as e:
+            self.error = e
+
+
+# Background removals started by replace_tree and not yet joined by deferred_discards
+_discards: List[_DiscardThread] = []
+
+
+def replace_tree(src: str, dst: str) -> None:
+    """Install a copy of the src tree at dst without dst ever being missing or partially copied.
+
+    The copy is staged next to dst and swapped in with renames. The tree it replaces is removed by a
+    background thread, so it overlaps whatever the install does next, and is joined when the enclosing
+    deferred_discards block exits. Calls must be made inside one, as that removal uses a thread pool,
+    which can't be used once the interpreter is shutting down.
+    """
+    parent, name = os.path.split(dst)
+    # Hidden names, so a half installed package version is never picked up from the staging paths
+    staging = os.path.join(parent, f".{name}.new")
+    retired = os.path.join(parent, f".{name}.old")
+
+    # Clear anything left behind by an interrupted install
+    remove_path(staging)
+    remove_path(retired)
+
+    copytree(src, staging)
+    try:
+        os.rename(dst, retired)
+    except FileNotFoundError:
+        os.rename(staging, dst)
+        return
+    os.rename(staging, dst)
+
+    thread = _DiscardThread(retired)
+    thread.start()
+    _discards.append(thread)
+
+
+def _join_discards() -> Optional[Exception]:
+    """Wait for the removals started by replace_tree, logging their errors and returning the first one."""
+    first_error = None
+    while _discards:
+        thread = _discards.pop(0)
+        thread.join()
+        if thread.error is not None:
+            logger.error(f"Failed to remove the replaced tree {thread.path}: {thread.error}")
+            first_error = first_error or thread.error
+    return first_error
+
+
+@contextlib.contextmanager
+def deferred_discards():
+    """Context manager for the replace_tree calls of an install, waiting for their background removals on exit.
+
+    The removal of a replaced tree is deferred rather than hidden: the first removal error is raised on exit,
+    unless the block itself raised, in which case the removal errors are only logged.
+    """
+    try:
+        yield
+    except BaseException:
+        _join_discards()
+        raise
+    error = _join_discards()
+    if error is not None:
+        raise error
+
+
+def _run_protoc(proto_src_path: str, out_path: str, proto_files: List[str]) -> int:
+    """Compile proto_files from proto_src_path into out_path with grpc_tools.protoc, returning its exit code."""
+    # Imported here, so the packages that don't compile protos don't need grpc_tools to build
+    from grpc_tools import protoc
+
+    # Well-known .proto files shipped with grpc_tools, added to the include path like its command line does
+    protoc_include = importlib.resources.files("grpc_tools") / "_proto"
+    protoc_args = [
+        "grpc_tools.protoc",
+        f"-I{proto_src_path}",
+        f"-I{protoc_include}",
+        f"--python_out={out_path}",
+        f"--grpc_python_out={out_path}",
+    ] + [os.path.join(proto_src_path, name) for name in proto_files]
+    return protoc.main(protoc_args)
+
+
+def _load_fix_compiled_proto(script_path: str):
+    """Import fix_compiled_proto from OpenCue's fix script, instead of running it in a new interpreter."""
+    spec = importlib.util.spec_from_file_location("fix_compiled_proto", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.fix_compiled_proto
+
+
+def _run_2to3(directory: str, filenames: List[str]) -> bool:
+    """In-process equivalent of `2to3 -w -n`, rewriting the files in place without backups.
+
+    Returns False, with a warning, when lib2to3 isn't available.
+    """
+    # lib2to3 is only imported when FORCE_2TO3=1 asks for it, as it warns about its own deprecation on
+    # import and is gone from Python 3.13 on
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            from lib2to3.refactor import RefactoringTool, get_fixers_from_package
+        except ImportError:
+            logger.warning("lib2to3 not available, skipping 2to3 conversion")
+            return False
+        tool = RefactoringTool(get_fixers_from_package("lib2to3.fixes"))
+        tool.refactor([os.path.join(directory, name) for name in filenames], write=True)
+    return True
+
+
+def compile_protos(
+    proto_src_path: str, out_path: str, fix_script_path: str, fix_imports: bool = True, run_2to3: bool = _FORCE_2TO3
+) -> None:
+    """Compile the .proto files of proto_src_path into a fresh out_path, and post-process the generated modules.
+
+    The imports are made relative with fix_script_path's fix_compiled_proto, and 2to3 is run over the modules if
+    run_2to3 is set, which it is by default only when FORCE_2TO3=1 is in the environment.
+    Raises TestError when there are no .proto files to compile, or protoc or the import fix fail.
+    """
+    # Get all .proto files, the listing doubling as the check that proto_src_path exists
+    try:
+        with os.scandir(proto_src_path) as it:
+            proto_files = [entry.name for entry in it if entry.name.endswith(".proto") and entry.is_file()]
+    except FileNotFoundError:
+        raise TestError(f"Proto source not found at {proto_src_path}")
+
+    if not proto_files:
+        raise TestError("No .proto files found in proto source directory")
+
+    logger.info(f"Found proto files: {proto_files}")
+
+    # Create the output directory
+    remove_path(out_path)
+    os.makedirs(out_path, exist_ok=True)
+
+    # Compile proto files with grpc_tools.protoc, spread over processes in batches. Each batch is one
+    # protoc run, so imported .proto files are parsed once per batch rather than once per file.
+    workers = min(_PROTOC_WORKERS, len(proto_files))
+    batches = [proto_files[i::workers] for i in range(workers)]
+    logger.info(f"Running protoc into {out_path} over {workers} process(es)")
+    if workers == 1:
+        exit_codes = [_run_protoc(proto_src_path, out_path, proto_files)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            exit_codes = list(executor.map(_run_protoc, repeat(proto_src_path), repeat(out_path), batches))
+
+    failed = [batch for batch, code in zip(batches, exit_codes) if code != 0]
+    if failed:
+        failed_files = [name for batch in failed for name in batch]
+        raise TestError(f"Proto compilation failed for {failed_files}, see the protoc errors above")
+    logger.info("Proto files compiled successfully")
+
+    # Fix compiled proto imports using OpenCue's fix script
+    if fix_imports:
+        if os.path.exists(fix_script_path):
+            logger.info("Running fix_compiled_proto.py to fix imports")
+            try:
+                _load_fix_compiled_proto(fix_script_path)(out_path)
+                logger.info("Proto imports fixed successfully")
+            except Exception as e:
+                logger.error(f"Failed to fix proto imports: {e}")
+                raise TestError(f"Proto import fixing failed: {e}")
+        else:
+            logger.warning(f"fix_compiled_proto.py not found at {fix_script_path}")
+
+    # Run 2to3 conversion on compiled proto files
+    if not run_2to3:
+        logger.info("Skipping 2to3 conversion, the compiled protos are already Python 3 (set FORCE_2TO3=1 to run it)")
+        return
+
+    # Get all .py files in the output directory
+    with os.scandir(out_path) as it:
+        py_files = [entry.name for entry in it if entry.name.endswith(".py") and entry.is_file()]
+    if py_files:
+        logger.info(f"Running 2to3 on {len(py_files)} Python files")
+        try:
+            if _run_2to3(out_path, py_files):
+                logger.info("2to3 conversion completed")
+        except Exception as e:
+            logger.warning(f"2to3 conversion failed or not needed: {e}")
+    else:
+        logger.warning("No Python files found for 2to3 conversion")
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2025. Od Studios, www.theodstudios.com, All rights reserved
+
+"""Tests for opencue_build_common."""
+
+import ast
+import errno
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+import opencue_build_common
+
+PROTO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class CopyFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, "src.bin")
+        self.dst = os.path.join(self.tmp.name, "dst.bin")
+        with open(self.src, "wb") as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 17))
+
+    def _copy(self):
+        opencue_build_common.copy_file(self.src, self.dst, os.stat(self.src))
+        with open(self.src, "rb") as src, open(self.dst, "rb") as dst:
+            self.assertEqual(src.read(), dst.read())
+
+    def test_copies_the_data(self):
+        self._copy()
+
+    def test_falls_back_when_copy_file_range_copies_nothing(self):
+        # A filesystem that accepts copy_file_range without implementing it, and doesn't do reflinks
+        no_clone = OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        with mock.patch.object(opencue_build_common.fcntl, "ioctl", side_effect=no_clone):
+            with mock.patch.object(os, "copy_file_range", return_value=0):
+                self._copy()
+
+    def test_falls_back_to_read_and_write(self):
+        no_clone = OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        no_sendfile = OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        with mock.patch.object(opencue_build_common.fcntl, "ioctl", side_effect=no_clone):
+            with mock.patch.object(os, "copy_file_range", side_effect=no_clone):
+                with mock.patch.object(os, "sendfile", side_effect=no_sendfile):
+                    self._copy()
+
+
+class CopytreeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, "src")
+        self.dst = os.path.join(self.tmp.name, "dst")
+        os.makedirs(os.path.join(self.src, "pkg", "__pycache__"))
+        with open(os.path.join(self.src, "pkg", "module.py"), "w") as f:
+            f.write("VALUE = 1\n")
+        os.chmod(os.path.join(self.src, "pkg", "module.py"), 0o640)
+        os.symlink("module.py", os.path.join(self.src, "pkg", "alias.py"))
+        os.symlink("pkg", os.path.join(self.src, "pkg_link"))
+
+    def test_copies_files_with_their_mode_and_times(self):
+        opencue_build_common.copytree(self.src, self.dst)
+
+        src_st = os.stat(os.path.join(self.src, "pkg", "module.py"))
+        dst_st = os.stat(os.path.join(self.dst, "pkg", "module.py"))
+        self.assertEqual(src_st.st_mode, dst_st.st_mode)
+        self.assertEqual(src_st.st_mtime_ns, dst_st.st_mtime_ns)
+        with open(os.path.join(self.dst, "pkg", "module.py")) as f:
+            self.assertEqual("VALUE = 1\n", f.read())
+
+    def test_recreates_symlinks_as_links(self):
+        opencue_build_common.copytree(self.src, self.dst)
+
+        self.assertEqual("module.py", os.readlink(os.path.join(self.dst, "pkg", "alias.py")))
+        self.assertEqual("pkg", os.readlink(os.path.join(self.dst, "pkg_link")))
+
+    def test_ignore(self):
+        opencue_build_common.copytree(self.src, self.dst, ignore=shutil.ignore_patterns("__pycache__"))
+
+        self.assertEqual(["alias.py", "module.py"], sorted(os.listdir(os.path.join(self.dst, "pkg"))))
+
+
+class RemovePathTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        self.target = os.path.join(self.root, "target")
+        os.makedirs(os.path.join(self.target, "kept"))
+
+    def test_removes_a_symlink_without_following_it(self):
+        link = os.path.join(self.root, "link")
+        os.symlink(self.target, link)
+
+        opencue_build_common.remove_path(link)
+
+        self.assertFalse(os.path.lexists(link))
+        self.assertTrue(os.path.isdir(os.path.join(self.target, "kept")))
+
+    def test_removes_a_tree_with_a_symlink_inside_without_following_it(self):
+        tree = os.path.join(self.root, "tree")
+        os.makedirs(os.path.join(tree, "a", "b"))
+        os.symlink(self.target, os.path.join(tree, "a", "link"))
+        with open(os.path.join(tree, "file.txt"), "w") as f:
+            f.write("x")
+
+        opencue_build_common.remove_path(tree)
+
+        self.assertFalse(os.path.lexists(tree))
+        self.assertTrue(os.path.isdir(os.path.join(self.target, "kept")))
+
+    def test_removes_a_file_and_ignores_a_missing_path(self):
+        path = os.path.join(self.root, "file.txt")
+        with open(path, "w") as f:
+            f.write("x")
+
+        opencue_build_common.remove_path(path)
+        opencue_build_common.remove_path(path)
+
+        self.assertFalse(os.path.lexists(path))
+
+
+class SyncTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, "src")
+        self.dst = os.path.join(self.tmp.name, "dst")
+        _write(os.path.join(self.src, "pkg", "module.py"), "VALUE = 1\n")
+        _write(os.path.join(self.src, "README.md"), "readme\n")
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+    def _touch(self, path, content):
+        # Bump the mtime as well, so the change is seen even when the size doesn't change
+        st = os.stat(path)
+        _write(path, content)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def test_removes_stale_entries(self):
+        os.remove(os.path.join(self.src, "README.md"))
+        shutil.rmtree(os.path.join(self.src, "pkg"))
+        _write(os.path.join(self.src, "other.py"), "")
+
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+        self.assertEqual(["other.py"], os.listdir(self.dst))
+
+    def test_leaves_unchanged_files_alone(self):
+        before = os.stat(os.path.join(self.dst, "pkg", "module.py")).st_ino
+
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+        self.assertEqual(before, os.stat(os.path.join(self.dst, "pkg", "module.py")).st_ino)
+
+    def test_recopies_changed_files(self):
+        self._touch(os.path.join(self.src, "pkg", "module.py"), "VALUE = 2\n")
+
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+        self.assertEqual("VALUE = 2\n", _read(os.path.join(self.dst, "pkg", "module.py")))
+        self.assertEqual(
+            os.stat(os.path.join(self.src, "pkg", "module.py")).st_mtime_ns,
+            os.stat(os.path.join(self.dst, "pkg", "module.py")).st_mtime_ns,
+        )
+
+    def test_writes_changed_read_only_files_to_a_new_file(self):
+        src_file = os.path.join(self.src, "pkg", "module.py")
+        dst_file = os.path.join(self.dst, "pkg", "module.py")
+        os.chmod(src_file, 0o444)
+        opencue_build_common.sync_tree(self.src, self.dst)
+        os.chmod(src_file, 0o644)
+        self._touch(src_file, "VALUE = 2\n")
+        os.chmod(src_file, 0o444)
+
+        # Truncating the stale copy would fail for a non-root user, and change it under its readers
+        with open(dst_file) as reader:
+            opencue_build_common.sync_tree(self.src, self.dst)
+            self.assertEqual("VALUE = 1\n", reader.read())
+
+        self.assertEqual("VALUE = 2\n", _read(dst_file))
+        self.assertEqual(0o444, stat.S_IMODE(os.stat(dst_file).st_mode))
+
+    def test_replaces_entries_that_changed_type(self):
+        # The file becomes a directory, the directory a symlink and a new file is in the way of a directory
+        os.remove(os.path.join(self.src, "README.md"))
+        _write(os.path.join(self.src, "README.md", "index.md"), "index\n")
+        shutil.rmtree(os.path.join(self.src, "pkg"))
+        os.symlink("README.md", os.path.join(self.src, "pkg"))
+        _write(os.path.join(self.dst, "data", "stale.txt"), "")
+        _write(os.path.join(self.src, "data"), "data\n")
+
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+        self.assertEqual("index\n", _read(os.path.join(self.dst, "README.md", "index.md")))
+        self.assertEqual("README.md", os.readlink(os.path.join(self.dst, "pkg")))
+        self.assertEqual("data\n", _read(os.path.join(self.dst, "data")))
+
+        # And back from a symlink to a file
+        os.remove(os.path.join(self.src, "pkg"))
+        _write(os.path.join(self.src, "pkg"), "pkg\n")
+
+        opencue_build_common.sync_tree(self.src, self.dst)
+
+        self.assertFalse(os.path.islink(os.path.join(self.dst, "pkg")))
+        self.assertEqual("pkg\n", _read(os.path.join(self.dst, "pkg")))
+
+    def test_sync_entries_leaves_unlisted_entries_alone(self):
+        _write(os.path.join(self.dst, "build.rxt"), "")
+        self._touch(os.path.join(self.src, "README.md"), "changed\n")
+        with os.scandir(self.src) as it:
+            entries = [entry for entry in it if entry.name == "README.md"]
+
+        opencue_build_common.sync_entries(self.src, self.dst, entries)
+
+        self.assertEqual("changed\n", _read(os.path.join(self.dst, "README.md")))
+        self.assertEqual(["README.md", "build.rxt", "pkg"], sorted(os.listdir(self.dst)))
+
+
+class ReplaceTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        self.src = os.path.join(self.root, "src")
+        os.makedirs(os.path.join(self.src, "pkg"))
+        with open(os.path.join(self.src, "pkg", "module.py"), "w") as f:
+            f.write("VALUE = 1\n")
+        # A few more top level entries, so the retired tree is removed over the thread pool
+        for i in range(20):
+            os.makedirs(os.path.join(self.src, f"data{i}"))
+            with open(os.path.join(self.src, f"data{i}", "file.txt"), "w") as f:
+                f.write(f"{i}\n")
+
+    def test_swaps_in_a_copy_of_the_new_tree(self):
+        install = os.path.join(self.root, "install")
+        _write(os.path.join(install, "pkg", "module.py"), "VALUE = 0\n")
+        _write(os.path.join(install, "removed.py"), "")
+        os.symlink("module.py", os.path.join(self.src, "pkg", "alias.py"))
+
+        with opencue_build_common.deferred_discards():
+            opencue_build_common.replace_tree(self.src, install)
+
+        self.assertEqual("VALUE = 1\n", _read(os.path.join(install, "pkg", "module.py")))
+        self.assertFalse(os.path.exists(os.path.join(install, "removed.py")))
+        self.assertEqual("module.py", os.readlink(os.path.join(install, "pkg", "alias.py")))
+        self.assertEqual(["install", "src"], sorted(os.listdir(self.root)))
+
+    def test_installs_where_nothing_was_installed(self):
+        install = os.path.join(self.root, "install")
+
+        opencue_build_common.replace_tree(self.src, install)
+
+        self.assertEqual("VALUE = 1\n", _read(os.path.join(install, "pkg", "module.py")))
+        self.assertEqual(["install", "src"], sorted(os.listdir(self.root)))
+
+    def test_clears_what_an_interrupted_install_left_behind(self):
+        install = os.path.join(self.root, "install")
+        _write(os.path.join(self.root, ".install.new", "partial.py"), "")
+        _write(os.path.join(self.root, ".install.old", "retired.py"), "")
+
+        opencue_build_common.replace_tree(self.src, install)
+
+        self.assertFalse(os.path.exists(os.path.join(install, "partial.py")))
+        self.assertEqual(["install", "src"], sorted(os.listdir(self.root)))
+
+    def _fail_to_remove_retired_trees(self):
+        remove_path = opencue_build_common.remove_path
+
+        def _remove_path(path):
+            if path.endswith(".old") and os.path.lexists(path):
+                raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), path)
+            remove_path(path)
+
+        return mock.patch.object(opencue_build_common, "remove_path", _remove_path)
+
+    def test_deferred_discards_raises_a_failed_removal_on_exit(self):
+        install = os.path.join(self.root, "install")
+        opencue_build_common.replace_tree(self.src, install)
+
+        with self._fail_to_remove_retired_trees():
+            with self.assertRaises(PermissionError):
+                with opencue_build_common.deferred_discards():
+                    opencue_build_common.replace_tree(self.src, install)
+
+        # The swap itself went through, and the error is only reported once
+        self.assertEqual("VALUE = 1\n", _read(os.path.join(install, "pkg", "module.py")))
+        with opencue_build_common.deferred_discards():
+            pass
+
+    def test_deferred_discards_keeps_the_error_of_the_install(self):
+        install = os.path.join(self.root, "install")
+        opencue_build_common.replace_tree(self.src, install)
+
+        with self._fail_to_remove_retired_trees():
+            with self.assertRaisesRegex(opencue_build_common.TestError, "bin not found"):
+                with opencue_build_common.deferred_discards():
+                    opencue_build_common.replace_tree(self.src, install)
+                    raise opencue_build_common.TestError("bin not found")
+
+    def test_install_twice_in_a_process_that_exits_leaves_no_old_tree(self):
+        # The retired tree is removed over a thread pool from a background thread, so this runs in a fresh
+        # interpreter that exits right after the second install, like a build does
+        script = textwrap.dedent(
+            f"""
+            import sys
+            sys.path.insert(0, {PROTO_DIR!r})
+            import opencue_build_common
+            with opencue_build_common.deferred_discards():
+                opencue_build_common.replace_tree({self.src!r}, {os.path.join(self.root, "install")!r})
+                opencue_build_common.replace_tree({self.src!r}, {os.path.join(self.root, "install")!r})
+            """
+        )
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertNotIn("Exception in thread", result.stderr)
+        self.assertEqual(["install", "src"], sorted(os.listdir(self.root)))
+        with open(os.path.join(self.root, "install", "pkg", "module.py")) as f:
+            self.assertEqual("VALUE = 1\n", f.read())
+
+
+class CompileProtosTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, "src")
+        self.out = os.path.join(self.tmp.name, "out")
+        self.fix_script = os.path.join(PROTO_DIR, "fix_compiled_proto.py")
+        self._proto("job.proto", 'import "common.proto";\nmessage Job { Id id = 1; }\n')
+        self._proto("common.proto", "message Id { string value = 1; }\n")
+        self._proto("host.proto", "message Host { string name = 1; }\n")
+        self._proto("service.proto", "message Empty {}\nservice Ping { rpc Ping(Empty) returns (Empty); }\n")
+        # The build hosts may have a single CPU, which never takes the multi-process path
+        patcher = mock.patch.object(opencue_build_common, "_PROTOC_WORKERS", 4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _proto(self, name, body):
+        _write(os.path.join(self.src, name), f'syntax = "proto3";\npackage opencue;\n{body}')
+
+    def _failed_files(self, error):
+        return sorted(ast.literal_eval(re.search(r"failed for (\[.*?\])", str(error)).group(1)))
+
+    def test_compiles_over_several_processes(self):
+        opencue_build_common.compile_protos(self.src, self.out, self.fix_script)
+
+        names = ("common", "host", "job", "service")
+        expected = sorted(f"{name}{suffix}.py" for name in names for suffix in ("_pb2", "_pb2_grpc"))
+        self.assertEqual(expected, sorted(os.listdir(self.out)))
+        # The imports between the generated modules were made relative by fix_compiled_proto
+        self.assertIn("from . import common_pb2 as common__pb2", _read(os.path.join(self.out, "job_pb2.py")))
+
+    def test_reports_the_broken_proto(self):
+        self._proto("host.proto", "message Host {\n")
+
+        with self.assertRaises(opencue_build_common.TestError) as context:
+            opencue_build_common.compile_protos(self.src, self.out, self.fix_script)
+
+        # Each of the four files is its own batch, so only the broken one is reported
+        self.assertEqual(["host.proto"], self._failed_files(context.exception))
+
+    def test_reports_the_files_of_every_failed_batch(self):
+        self._proto("host.proto", "message Host {\n")
+        self._proto("service.proto", "service Ping { rpc Ping(Missing) returns (Missing); }\n")
+
+        with self.assertRaises(opencue_build_common.TestError) as context:
+            opencue_build_common.compile_protos(self.src, self.out, self.fix_script)
+
+        self.assertEqual(["host.proto", "service.proto"], self._failed_files(context.exception))
+
+    def test_reports_a_failed_import_fix(self):
+        fix_script = os.path.join(self.tmp.name, "fix_compiled_proto.py")
+        _write(fix_script, "def fix_compiled_proto(path):\n    raise ValueError('bad import')\n")
+
+        with self.assertRaisesRegex(opencue_build_common.TestError, "Proto import fixing failed: bad import"):
+            opencue_build_common.compile_protos(self.src, self.out, fix_script)
+
+    def test_missing_source(self):
+        with self.assertRaisesRegex(opencue_build_common.TestError, "Proto source not found"):
+            opencue_build_common.compile_protos(os.path.join(self.tmp.name, "missing"), self.out, self.fix_script)
+
+
+if __name__ == "__main__":
+    unittest.main()
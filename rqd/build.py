@@ -5,46 +5,67 @@
 import os
 import os.path
 import shutil
-import subprocess
 import sys
 from typing import List
 
 from loguru import logger
 
+# The helpers shared with pycue live next to the .proto sources they compile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "proto"))
 
-class TestError(Exception):
-    pass
+from opencue_build_common import (  # noqa: E402
+    TestError,
+    compile_protos,
+    copytree,
+    deferred_discards,
+    remove_path,
+    replace_tree,
+    write_executable,
+)
+
+# Import prefix rewritten in the RQD sources by _fix_rqd_imports
+_OPENCUE_PROTO_PREFIX = b"opencue_proto."
+_COMPILED_PROTO_PREFIX = b"rqd.compiled_proto."
 
 
 def _fix_rqd_imports(rqd_directory):
     """Fix import statements in RQD source files to use compiled_proto instead of opencue_proto."""
-    logger.info("Fixing opencue_proto imports to use rqd.compiled_proto")
-
     # Files that need import fixes
     files_to_fix = ["rqcore.py", "rqmachine.py", "rqnetwork.py", "rqdservicers.py", "cuerqd.py"]
 
+    updated = []
     for filename in files_to_fix:
         filepath = os.path.join(rqd_directory, filename)
-        if os.path.exists(filepath):
-            logger.info(f"Fixing imports in {filename}")
+        try:
+            fd = os.open(filepath, os.O_RDONLY)
+        except FileNotFoundError:
+            logger.warning(f"File not found: {filepath}")
+            continue
 
-            with open(filepath, "r") as f:
-                content = f.read()
+        logger.debug("Fixing imports in {}", filename)
+        try:
+            content = os.read(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
 
-            # Replace opencue_proto imports with compiled_proto imports
-            # Handle both "import opencue_proto.X" and "from opencue_proto.X import Y"
-            content = content.replace("import opencue_proto.", "import rqd.compiled_proto.")
-            content = content.replace("from opencue_proto.", "from rqd.compiled_proto.")
+        # A single replace covers "import opencue_proto.X", "from opencue_proto.X import Y"
+        # and direct uses like class inheritance, as the rewritten prefix never matches again
+        fixed = content.replace(_OPENCUE_PROTO_PREFIX, _COMPILED_PROTO_PREFIX)
+        if fixed == content:
+            logger.debug("No imports to update in {}", filename)
+            continue
 
-            # Also handle cases where opencue_proto is used directly (like in class inheritance)
-            content = content.replace("opencue_proto.", "rqd.compiled_proto.")
+        fd = os.open(filepath, os.O_WRONLY | os.O_TRUNC)
+        try:
+            view = memoryview(fixed)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
 
-            with open(filepath, "w") as f:
-                f.write(content)
+        updated.append(filename)
 
-            logger.info(f"Updated imports in {filename}")
-        else:
-            logger.warning(f"File not found: {filepath}")
+    logger.info(f"Fixed opencue_proto imports in {len(updated)} files: {updated}")
 
 
 def build(source_path: str, build_path: str, install_path: str, targets: List[str]) -> None:
@@ -55,108 +76,27 @@ def build(source_path: str, build_path: str, install_path: str, targets: List[st
 
     @logger.catch(exception=TestError, reraise=True)
     def _build():
-        # Option 4 approach: Compile proto files directly
-        proto_src_path = os.path.join(os.path.dirname(source_path), "proto", "src")
-        compiled_proto_path = os.path.join(source_path, "rqd", "compiled_proto")
-
-        if os.path.exists(proto_src_path):
-            logger.info("Compiling proto files (Option 4 approach)")
-
-            # Create compiled_proto directory
-            if os.path.exists(compiled_proto_path):
-                shutil.rmtree(compiled_proto_path)
-            os.makedirs(compiled_proto_path, exist_ok=True)
-
-            # Get all .proto files
-            proto_files = []
-            for file in os.listdir(proto_src_path):
-                if file.endswith(".proto"):
-                    proto_files.append(file)
-
-            if not proto_files:
-                raise TestError("No .proto files found in proto source directory")
-
-            logger.info(f"Found proto files: {proto_files}")
-
-            # Compile proto files using grpc_tools.protoc
-            try:
-                cmd = [
-                    sys.executable,
-                    "-m",
-                    "grpc_tools.protoc",
-                    "-I=.",
-                    f"--python_out={compiled_proto_path}",
-                    f"--grpc_python_out={compiled_proto_path}",
-                ] + proto_files
-
-                logger.info(f"Running command: {' '.join(cmd)}")
-                logger.info(f"Working directory: {proto_src_path}")
-
-                result = subprocess.run(cmd, cwd=proto_src_path, check=True, capture_output=True, text=True)
-                logger.info("Proto files compiled successfully")
-                if result.stdout:
-                    logger.info(f"stdout: {result.stdout}")
-                if result.stderr:
-                    logger.info(f"stderr: {result.stderr}")
-
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to compile proto files: {e}")
-                logger.error(f"stdout: {e.stdout}")
-                logger.error(f"stderr: {e.stderr}")
-                raise TestError(f"Proto compilation failed: {e}")
-
-            # Fix compiled proto imports using OpenCue's fix script
-            fix_script_path = os.path.join(os.path.dirname(source_path), "proto", "fix_compiled_proto.py")
-            if os.path.exists(fix_script_path):
-                logger.info("Running fix_compiled_proto.py to fix imports")
-                try:
-                    subprocess.run(
-                        [sys.executable, fix_script_path, compiled_proto_path],
-                        check=True,
-                        capture_output=True,
-                        text=True,
-                    )
-                    logger.info("Proto imports fixed successfully")
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"Failed to fix proto imports: {e}")
-                    logger.error(f"stdout: {e.stdout}")
-                    logger.error(f"stderr: {e.stderr}")
-                    raise TestError(f"Proto import fixing failed: {e}")
-            else:
-                logger.warning(f"fix_compiled_proto.py not found at {fix_script_path}")
-
-            # Run 2to3 conversion on compiled proto files
-            try:
-                # Get all .py files in compiled_proto directory
-                py_files = [f for f in os.listdir(compiled_proto_path) if f.endswith(".py")]
-                if py_files:
-                    logger.info(f"Running 2to3 on {len(py_files)} Python files")
-                    subprocess.run(
-                        ["2to3", "-w", "-n"] + py_files,
-                        cwd=compiled_proto_path,
-                        check=True,
-                        capture_output=True,
-                        text=True,
-                    )
-                    logger.info("2to3 conversion completed")
-                else:
-                    logger.warning("No Python files found for 2to3 conversion")
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"2to3 conversion failed or not needed: {e}")
-            except FileNotFoundError:
-                logger.warning("2to3 tool not found, skipping conversion")
-        else:
+        # The proto sources and fix script sit next to the package, so check for them before doing any work
+        proto_path = os.path.join(os.path.dirname(source_path), "proto")
+        proto_src_path = os.path.join(proto_path, "src")
+        fix_script_path = os.path.join(proto_path, "fix_compiled_proto.py")
+        if not os.path.isdir(proto_src_path):
             raise TestError(f"Proto source not found at {proto_src_path}")
 
-        # Copy source files to build directory (Option 4 approach - no pip needed)
+        # Copy source files to build directory (Option 4 approach - no pip needed). compiled_proto is left out, as
+        # the protos are compiled straight into the build copy below, and the source tree is never written to.
         logger.info("Copying source files to build directory")
         rqd_src = os.path.join(source_path, "rqd")
         rqd_dest = os.path.join(build_path, "rqd")
 
-        if os.path.exists(rqd_dest):
-            shutil.rmtree(rqd_dest)
+        remove_path(rqd_dest)
+        copytree(rqd_src, rqd_dest, ignore=shutil.ignore_patterns("compiled_proto", "__pycache__"))
 
-        shutil.copytree(rqd_src, rqd_dest)
+        # Option 4 approach: Compile proto files directly
+        compiled_proto_path = os.path.join(rqd_dest, "compiled_proto")
+
+        logger.info("Compiling proto files (Option 4 approach)")
+        compile_protos(proto_src_path, compiled_proto_path, fix_script_path)
 
         # Fix imports in RQD source files to use compiled_proto instead of opencue_proto
         logger.info("Fixing opencue_proto imports in RQD source files")
@@ -186,10 +126,7 @@ if __name__ == '__main__':
     sys.exit(main())
 """
 
-        with open(rqd_exe, "w") as f:
-            f.write(rqd_script)
-
-        os.chmod(rqd_exe, 0o755)
+        write_executable(rqd_exe, rqd_script.encode())
         logger.info(f"Created rqd executable at {rqd_exe}")
 
     def _install():
@@ -201,9 +138,7 @@ if __name__ == '__main__':
 
         if os.path.exists(rqd_build):
             logger.info(f"Installing rqd from {rqd_build} to {rqd_install}")
-            if os.path.exists(rqd_install):
-                shutil.rmtree(rqd_install)
-            shutil.copytree(rqd_build, rqd_install)
+            replace_tree(rqd_build, rqd_install)
         else:
             raise TestError(f"RQD build directory not found: {rqd_build}")
 
@@ -213,16 +148,15 @@ if __name__ == '__main__':
 
         if os.path.exists(bin_build):
             logger.info(f"Installing bin from {bin_build} to {bin_install}")
-            if os.path.exists(bin_install):
-                shutil.rmtree(bin_install)
-            shutil.copytree(bin_build, bin_install)
+            replace_tree(bin_build, bin_install)
         else:
             raise TestError(f"Bin build directory not found: {bin_build}")
 
     _build()
 
     if "install" in (targets or []):
-        _install()
+        with deferred_discards():
+            _install()
 
 
 if __name__ == "__main__":